@@ -1,11 +1,18 @@
 #!/usr/bin/env python3
 DEPRECATION = 'NOTE: this is DEPRECATED! Please use https://github.com/seanbreckenridge/browserexport instead'
 
+import argparse
 from datetime import datetime
 from pathlib import Path
 from subprocess import check_output
-import filecmp
+import errno
+import hashlib
 import logging
+from logging.handlers import MemoryHandler
+import os
+import shutil
+import sqlite3
+import time
 import warnings
 import sys
 
@@ -17,7 +24,14 @@ CHROME = 'chrome'
 FIREFOX = 'firefox'
 
 def get_logger():
-    return logging.getLogger('browser-history')
+    logger = logging.getLogger('browser-history')
+    if not logger.handlers:
+        # buffer records and write them out in batches; warnings are flushed straight away
+        # (logging.shutdown flushes whatever is left at exit)
+        handler = MemoryHandler(capacity=64, flushLevel=logging.WARNING, target=logging.StreamHandler())
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+    return logger
 
 
 # TODO kython?
@@ -50,22 +64,246 @@ def test_get_path():
     get_path('firefox', profile='*-release')
 
 
-def atomic_copy(src: Path, dest: Path):
+def sqlite_backup(src: Path, dest: Path, *, timeout: float=5.0) -> None:
     """
-    Supposed to handle cases where the file is changed while we were copying it.
+    Takes a consistent snapshot of the database, even if the browser is writing to it at the same time.
     """
-    import shutil
+    # https://docs.python.org/3/library/sqlite3.html#sqlite3.Connection.backup
+    sconn = sqlite3.connect(f'{src.absolute().as_uri()}?mode=ro', uri=True, timeout=timeout)
+    dconn = sqlite3.connect(dest)
+    deadline = time.monotonic() + timeout
+
+    # backup() retries forever while the source is locked (and doesn't respect the connection timeout)
+    # progress is called after every step, including the busy ones, so we can bail from there
+    def progress(status: int, remaining: int, total: int) -> None:
+        if time.monotonic() > deadline:
+            raise sqlite3.OperationalError('database is locked')
+
+    try:
+        with dconn:
+            sconn.backup(dconn, progress=progress)
+    finally:
+        dconn.close()
+        sconn.close()
+
 
-    differs = True
-    while differs:
-        res = shutil.copy(src, dest)
-        differs = not filecmp.cmp(str(src), str(res))
+# flip to False once we discover the kernel/filesystem doesn't support them
+has_copy_file_range = hasattr(os, 'copy_file_range')
+has_sendfile = sys.platform == 'linux' and hasattr(os, 'sendfile')
+
+_UNSUPPORTED_ERRNOS = {errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP}
+
+
+def file_copy(src: Path, dest: Path) -> None:
+    """
+    Plain file copy, but lets the kernel do the work where possible (or even clone the file on reflink-capable filesystems)
+    """
+    global has_copy_file_range, has_sendfile
+    if sys.platform == 'darwin':
+        # uses fcopyfile, which clones files on APFS
+        shutil.copyfile(src, dest)
+        return
+
+    with src.open('rb') as fsrc, dest.open('wb') as fdst:
+        sfd, dfd = fsrc.fileno(), fdst.fileno()
+        length = os.fstat(sfd).st_size
+        if has_copy_file_range:
+            written = 0
+            try:
+                while written < length:
+                    n = os.copy_file_range(sfd, dfd, length - written)
+                    if n == 0:
+                        break # file shrunk while we were copying
+                    written += n
+            except OSError as e:
+                if e.errno not in _UNSUPPORTED_ERRNOS or written > 0:
+                    raise e
+                has_copy_file_range = False
+            else:
+                if written > 0 or length == 0:
+                    return
+                # some kernel/filesystem combinations just return 0 without copying anything
+                has_copy_file_range = False
+        if has_sendfile:
+            # still keeps the data in the kernel, avoids copying it through userspace buffers
+            offset = 0
+            try:
+                while offset < length:
+                    n = os.sendfile(dfd, sfd, offset, min(length - offset, 1 << 20))
+                    if n == 0:
+                        break # file shrunk while we were copying
+                    offset += n
+            except OSError as e:
+                if e.errno not in _UNSUPPORTED_ERRNOS or offset > 0:
+                    raise e
+                has_sendfile = False
+            else:
+                if offset > 0 or length == 0:
+                    return
+                has_sendfile = False
+        shutil.copyfileobj(fsrc, fdst)
+
+
+def _check_file_copy(tmp_path: Path) -> None:
+    src = tmp_path / 'src'
+    # bigger than a single sendfile chunk
+    data = os.urandom(3 * (1 << 20) + 123)
+    src.write_bytes(data)
+    dest = tmp_path / 'dest'
+    file_copy(src, dest)
+    assert dest.read_bytes() == data
+
+
+def test_file_copy(tmp_path: Path) -> None:
+    _check_file_copy(tmp_path)
+
+
+def test_file_copy_sendfile(tmp_path: Path, monkeypatch) -> None:
+    monkeypatch.setattr(sys.modules[__name__], 'has_copy_file_range', False)
+    _check_file_copy(tmp_path)
+
+
+def test_file_copy_userspace(tmp_path: Path, monkeypatch) -> None:
+    monkeypatch.setattr(sys.modules[__name__], 'has_copy_file_range', False)
+    monkeypatch.setattr(sys.modules[__name__], 'has_sendfile', False)
+    _check_file_copy(tmp_path)
+
+
+def test_file_copy_copy_file_range_noop(tmp_path: Path, monkeypatch) -> None:
+    monkeypatch.setattr(sys.modules[__name__], 'has_copy_file_range', True)
+    monkeypatch.setattr(os, 'copy_file_range', lambda *args: 0, raising=False)
+    _check_file_copy(tmp_path)
+    assert not has_copy_file_range
+
+
+def test_file_copy_sendfile_noop(tmp_path: Path, monkeypatch) -> None:
+    monkeypatch.setattr(sys.modules[__name__], 'has_copy_file_range', False)
+    monkeypatch.setattr(sys.modules[__name__], 'has_sendfile', True)
+    monkeypatch.setattr(os, 'sendfile', lambda *args: 0, raising=False)
+    _check_file_copy(tmp_path)
+    assert not has_sendfile
+
+
+def _digest(p: Path) -> bytes:
+    with p.open('rb') as f:
+        if hasattr(hashlib, 'file_digest'): # python 3.11+
+            return hashlib.file_digest(f, 'sha256').digest()
+        h = hashlib.sha256()
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+        return h.digest()
+
+
+def same_contents(a: Path, b: Path) -> bool:
+    if a.stat().st_size != b.stat().st_size:
+        return False
+    return _digest(a) == _digest(b)
+
+
+def atomic_file_copy(src: Path, dest: Path) -> None:
+    """
+    Supposed to handle cases where the file is changed while we were copying it.
+    """
+    while True:
+        file_copy(src, dest)
+        if same_contents(src, dest):
+            return
 
 
 def format_dt(dt: datetime) -> str:
     return dt.strftime('%Y%m%d%H%M%S')
 
 
+def snapshot(src: Path, dest: Path, *, timeout: float=5.0) -> None:
+    logger = get_logger()
+    # if your chrome is open, database would normally be locked, so you can't just copy the file
+    # backup API cooperates with sqlite locking, so we get a consistent snapshot in one pass
+    try:
+        sqlite_backup(src, dest, timeout=timeout)
+    except sqlite3.OperationalError as e:
+        # e.g. browser keeping the database under an exclusive lock
+        logger.warning('sqlite backup failed (%s), falling back to copying the file', e)
+        dest.unlink(missing_ok=True)
+        # so we'll just copy it till it converges. bit paranoid, but should work
+        atomic_file_copy(src, dest)
+
+
+def _make_db(path: Path) -> None:
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.execute('CREATE TABLE visits(url TEXT)')
+        conn.execute("INSERT INTO visits VALUES ('https://example.com')")
+    conn.close()
+
+
+def _query_db(path: Path):
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute('SELECT * FROM visits').fetchall()
+    finally:
+        conn.close()
+
+
+def test_snapshot(tmp_path: Path) -> None:
+    # weird characters shouldn't break the sqlite uri
+    sdir = tmp_path / 'a dir?x#%'
+    sdir.mkdir()
+    src = sdir / 'History'
+    _make_db(src)
+    dest = tmp_path / 'backup'
+    snapshot(src, dest)
+    assert _query_db(dest) == [('https://example.com',)]
+
+
+def test_snapshot_locked(tmp_path: Path) -> None:
+    src = tmp_path / 'History'
+    _make_db(src)
+    # that's what browsers do while they are running
+    locker = sqlite3.connect(src)
+    locker.execute('PRAGMA locking_mode=exclusive')
+    locker.execute('BEGIN EXCLUSIVE')
+    try:
+        dest = tmp_path / 'backup'
+        try:
+            sqlite_backup(src, dest, timeout=0.1)
+        except sqlite3.OperationalError:
+            pass
+        else:
+            raise AssertionError('expected the backup to fail on a locked database')
+
+        snapshot(src, dest, timeout=0.1)
+    finally:
+        locker.close()
+    assert _query_db(dest) == [('https://example.com',)]
+
+
+def test_snapshot_locked_after_connect(tmp_path: Path, monkeypatch) -> None:
+    src = tmp_path / 'History'
+    _make_db(src)
+    lockers = []
+    connect = sqlite3.connect
+
+    # browser grabs the lock after we've connected, but before the backup started
+    def connect_and_lock(*args, **kwargs):
+        conn = connect(*args, **kwargs)
+        if kwargs.get('uri') and not lockers:
+            locker = connect(src)
+            locker.execute('PRAGMA locking_mode=exclusive')
+            locker.execute('BEGIN EXCLUSIVE')
+            lockers.append(locker)
+        return conn
+
+    monkeypatch.setattr(sqlite3, 'connect', connect_and_lock)
+    dest = tmp_path / 'backup'
+    try:
+        snapshot(src, dest, timeout=0.1)
+    finally:
+        for l in lockers:
+            l.close()
+    assert len(lockers) == 1
+    assert _query_db(dest) == [('https://example.com',)]
+
+
 def backup_history(browser: Browser, to: Path, profile: str='*', pattern=None) -> Path:
     assert to.is_dir()
     logger = get_logger()
@@ -80,9 +318,7 @@ def backup_history(browser: Browser, to: Path, profile: str='*', pattern=None) -
 
     res = to / fname
     logger.info('backing up to %s', res)
-    # if your chrome is open, database would normally be locked, so you can't just make a snapshot
-    # so we'll just copy it till it converge. bit paranoid, but should work
-    atomic_copy(path, res)
+    snapshot(path, res)
     logger.info('done!')
     return res
 
@@ -111,7 +347,6 @@ def test_guess(tmp_path):
 
 def main():
     logger = get_logger()
-    import argparse
     p = argparse.ArgumentParser()
     p.add_argument('--browser', type=Browser, required=True)
     p.add_argument('--profile', type=str, default='*', help='Use to pick the correct profile to back up. If unspecified, will assume a single profile')
@@ -7,18 +7,26 @@ import sys
 import time
 from pathlib import Path
 import platform
+import shlex
 import shutil
+from string import Template
 from subprocess import check_call, run
-from typing import List
+from typing import Callable, Dict, FrozenSet, List, NamedTuple, Tuple
 
 SYSTEM = platform.system()
 UNSUPPORTED_SYSTEM = RuntimeError(f'Platform {SYSTEM} is not supported yet!')
 NO_SYSTEMD = RuntimeError('systemd not detected, find your own way to start promnesia automatically')
+NO_LAUNCHD = RuntimeError('launchd not detected, find your own way to start promnesia automatically')
+
+# checked once on import rather than every time we need to know
+# https://www.freedesktop.org/software/systemd/man/sd_booted.html
+_HAS_SYSTEMD = SYSTEM == 'Linux' and Path('/run/systemd/system/').exists()
+_HAS_LAUNCHD = SYSTEM == 'Darwin' and Path('/bin/launchctl').exists()
 
 from ..common import root
 from ..server import setup_parser as server_setup_parser
 
-SYSTEMD_TEMPLATE = '''
+SYSTEMD_TEMPLATE = Template('''
 [Unit]
 Description=Promnesia browser extension backend
 
@@ -26,22 +34,22 @@ Description=Promnesia browser extension backend
 WantedBy=default.target
 
 [Service]
-ExecStart={launcher} {extra_args}
+ExecStart=$launcher $extra_args
 Type=simple
 Restart=always
-'''
+''')
 
-LAUNCHD_TEMPLATE = '''
+LAUNCHD_TEMPLATE = Template('''
 <?xml version="1.0" encoding="UTF-8"?>
 <!DOCTYPE plist PUBLIC "-//Apple//DTD PLIST 1.0//EN" "http://www.apple.com/DTDs/PropertyList-1.0.dtd">
 <plist version="1.0">
         <dict>
                 <key>Label</key>
-                <string>{service_name}</string>
+                <string>$service_name</string>
 
                 <key>ProgramArguments</key>
                 <array>
-{arguments}
+$arguments
                 </array>
 
                 <key>RunAtLoad</key>
@@ -50,7 +58,7 @@ LAUNCHD_TEMPLATE = '''
                 <true/>
         </dict>
 </plist>
-'''
+''')
 
 
 def systemd(*args: str | Path, method=check_call) -> None:
@@ -62,29 +70,34 @@ def systemd(*args: str | Path, method=check_call) -> None:
 def install_systemd(name: str, out: Path, launcher: str, largs: List[str]) -> None:
     unit_name = name
 
-    import shlex
     extra_args = ' '.join(shlex.quote(str(a)) for a in largs)
 
-    out.write_text(SYSTEMD_TEMPLATE.format(
+    out.write_text(SYSTEMD_TEMPLATE.substitute(
         launcher=launcher,
         extra_args=extra_args,
     ))
 
     try:
-        systemd('stop' , unit_name, method=run) # ignore errors here if it wasn't running in the first place
         systemd('daemon-reload')
-        systemd('enable', unit_name)
-        systemd('start' , unit_name)
-        systemd('status', unit_name)
+        systemd('enable' , unit_name)
+        # restart starts the unit if it wasn't running in the first place
+        systemd('restart', unit_name)
+        systemd('status' , unit_name)
     except Exception as e:
         print(f"Something has gone wrong... you might want to use 'journalctl --user -u {unit_name}' to investigate", file=sys.stderr)
         raise e
 
 
+def _launchctl_labels() -> FrozenSet[str]:
+    # first line is the header: PID Status Label
+    res = run(['launchctl', 'list'], capture_output=True, text=True, check=True)
+    return frozenset(line.split('\t')[-1] for line in res.stdout.splitlines()[1:])
+
+
 def install_launchd(name: str, out: Path, launcher: str, largs: List[str]) -> None:
     service_name = name
     arguments = '\n'.join(f'<string>{a}</string>' for a in [launcher, *largs])
-    out.write_text(LAUNCHD_TEMPLATE.format(
+    out.write_text(LAUNCHD_TEMPLATE.substitute(
         service_name=service_name,
         arguments=arguments,
     ))
@@ -93,26 +106,57 @@ def install_launchd(name: str, out: Path, launcher: str, largs: List[str]) -> No
     check_call(cmd)
 
     time.sleep(1) # to give it some time? not sure if necessary
-    check_call(f'launchctl list | grep {name}', shell=True)
+    if service_name not in _launchctl_labels():
+        raise RuntimeError(f"{service_name} isn't in 'launchctl list' output")
 
 
-def install(args: argparse.Namespace) -> None:
-    name = args.name
+def _systemd_service_file(name: str) -> Tuple[str, Path]:
+    suf = '.service'
+    if Path(name).suffix != suf:
+        name = name + suf
     # todo use appdirs for config dir detection
-    if SYSTEM == 'Linux':
-        # Check for existence of systemd
-        # https://www.freedesktop.org/software/systemd/man/sd_booted.html
-        if not Path('/run/systemd/system/').exists():
-            raise NO_SYSTEMD
-        suf = '.service'
-        if Path(name).suffix != suf:
-            name = name + suf
-        out = Path(f'~/.config/systemd/user/{name}')
-    elif SYSTEM == 'Darwin': # osx
-        out = Path(f'~/Library/LaunchAgents/{name}.plist')
-    else:
+    return name, Path('~/.config/systemd/user').expanduser() / name
+
+
+def _launchd_service_file(name: str) -> Tuple[str, Path]:
+    return name, Path('~/Library/LaunchAgents').expanduser() / f'{name}.plist'
+
+
+class PlatformCfg(NamedTuple):
+    default_name: str
+    available: bool
+    not_available: Exception
+    # takes service name, returns normalised name and the file to write the service definition to
+    service_file: Callable[[str], Tuple[str, Path]]
+    install: Callable[[str, Path, str, List[str]], None]
+
+
+_PLATFORM: Dict[str, PlatformCfg] = {
+    'Linux': PlatformCfg(
+        default_name='promnesia.service',
+        available=_HAS_SYSTEMD,
+        not_available=NO_SYSTEMD,
+        service_file=_systemd_service_file,
+        install=install_systemd,
+    ),
+    'Darwin': PlatformCfg( # osx
+        default_name='com.github.karlicoss.promnesia',
+        available=_HAS_LAUNCHD,
+        not_available=NO_LAUNCHD,
+        service_file=_launchd_service_file,
+        install=install_launchd,
+    ),
+}
+
+
+def install(args: argparse.Namespace) -> None:
+    cfg = _PLATFORM.get(SYSTEM)
+    if cfg is None:
         raise UNSUPPORTED_SYSTEM
-    out = out.expanduser()
+    if not cfg.available:
+        raise cfg.not_available
+
+    name, out = cfg.service_file(args.name)
     print(f"Writing launch script to {out}", file=sys.stderr)
 
     # ugh. we want to know whether we're invoked 'properly' as an executable or ad-hoc via scripts/promnesia
@@ -132,22 +176,13 @@ def install(args: argparse.Namespace) -> None:
     ]
 
     out.parent.mkdir(parents=True, exist_ok=True) # sometimes systemd dir doesn't exist
-    if SYSTEM == 'Linux':
-        install_systemd(name=name, out=out, launcher=launcher, largs=largs)
-    elif SYSTEM == 'Darwin':
-        install_launchd(name=name, out=out, launcher=launcher, largs=largs)
-    else:
-        raise UNSUPPORTED_SYSTEM
+    cfg.install(name, out, launcher, largs)
 
 
 def setup_parser(p: argparse.ArgumentParser) -> None:
-    if SYSTEM == 'Linux':
-        dflt = 'promnesia.service'
-    elif SYSTEM == 'Darwin':
-        dflt = 'com.github.karlicoss.promnesia'
-    else:
-        # defensive here because setup_parser is called regardless whether the functionality is used
-        dflt = NotImplemented
+    cfg = _PLATFORM.get(SYSTEM)
+    # defensive here because setup_parser is called regardless whether the functionality is used
+    dflt = NotImplemented if cfg is None else cfg.default_name
 
     p.add_argument('--name', type=str, default=dflt, help='Systemd/launchd service name')
     p.add_argument('--unit-name', type=str, dest='name', help='DEPRECATED, same as --name')